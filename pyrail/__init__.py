@@ -1,4 +1,4 @@
 """Package initialization for pyrail."""
-from .irail import iRail
+from .irail import IRailValidationError, iRail
 
-__all__ = ["iRail"]
+__all__ = ["IRailValidationError", "iRail"]
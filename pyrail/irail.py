@@ -1,8 +1,17 @@
 import logging
-from asyncio import Lock
+from asyncio import Condition
 import asyncio
-from aiohttp import ClientSession, ClientError
-import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+from aiohttp import ClientError, ClientSession, TCPConnector
+from multidict import MultiDict
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,8 +26,42 @@ methods = {
     'disturbances': []
     }
 
+allowed_params = {method: frozenset(params) for method, params in methods.items()}
+
+xor_params = {
+    'liveboard': frozenset(['station', 'id']),
+    }
+
+urls = {method: base_url.format(method) for method in methods}
+
 headers = {'user-agent': 'pyRail (tielemans.jorim@gmail.com)'}
 
+RESPONSE_CACHE_SIZE = 32
+
+# Retry policy for HTTP 429 responses
+MAX_RETRIES = 5
+MAX_RETRY_DELAY = 30
+
+
+def _parse_retry_after(value):
+    """Return the delay in seconds from a Retry-After header, or None if missing or invalid."""
+    if not value:
+        return None
+    if value.isascii() and value.isdecimal():
+        return int(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class IRailValidationError(ValueError):
+    """Raised when a request to the iRail API has invalid parameters."""
+
+
 """
 This module provides the iRail class for interacting with the iRail API.
 """
@@ -32,6 +75,19 @@ class iRail:
 
     """
 
+    __slots__ = (
+        '__format',
+        '__lang',
+        '_base_params',
+        'tokens',
+        'burst_tokens',
+        'last_request_time',
+        '_token_available',
+        'response_cache',
+        'session',
+        '_inflight',
+    )
+
     def __init__(self, format='json', lang='en'):
         """Initialize the iRail API client.
 
@@ -40,21 +96,29 @@ class iRail:
             lang (str): The language for API responses. Default is 'en'.
 
         """
+        self._base_params = MultiDict()
         self.format = format
         self.lang = lang
         self.tokens = 3
         self.burst_tokens = 5
-        self.last_request_time = time.time()
-        self.lock = Lock()
-        self.etag_cache = {}
+        self.last_request_time = 0.0
+        self._token_available = Condition()
+        self.response_cache = OrderedDict()
         self.session = None
+        self._inflight = {}
         logger.info("iRail instance created")
 
     async def __aenter__(self):
-        self.session = ClientSession(headers=headers)
+        connector = TCPConnector(limit=10, limit_per_host=10, keepalive_timeout=75, ttl_dns_cache=300)
+        self.session = ClientSession(connector=connector, headers=headers)
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
+        # Shielded requests can outlive their callers
+        tasks = list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         await self.session.close()
 
     @property
@@ -67,6 +131,7 @@ class iRail:
             self.__format = value
         else:
             self.__format = 'json'
+        self._base_params['format'] = self.__format
 
     @property
     def lang(self):
@@ -78,10 +143,10 @@ class iRail:
             self.__lang = value
         else:
             self.__lang = 'en'
+        self._base_params['lang'] = self.__lang
 
     def _refill_tokens(self):
-        logger.debug("Refilling tokens")
-        current_time = time.time()
+        current_time = asyncio.get_running_loop().time()
         elapsed = current_time - self.last_request_time
         self.last_request_time = current_time
 
@@ -95,86 +160,167 @@ class iRail:
         if self.burst_tokens > 5:
             self.burst_tokens = 5
 
+    async def _handle_rate_limit(self):
+        """Take a token from the bucket, waiting for one to refill if needed."""
+        self._refill_tokens()
+
+        # No await between check and decrement, so the fast path needs no lock
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return
+        if self.burst_tokens >= 1:
+            self.burst_tokens -= 1
+            return
+
+        logger.warning("Rate limiting, waiting for tokens")
+        async with self._token_available:
+            self._refill_tokens()
+            while self.tokens < 1 and self.burst_tokens < 1:
+                try:
+                    await asyncio.wait_for(self._token_available.wait(), (1 - max(self.tokens, self.burst_tokens)) / 3)
+                except asyncio.TimeoutError:
+                    pass
+                self._refill_tokens()
+            if self.tokens >= 1:
+                self.tokens -= 1
+            else:
+                self.burst_tokens -= 1
+
+    def _validate_date(self, date):
+        """Check that a date is empty or in the ddmmyy format expected by the API."""
+        if not date:
+            return True
+        date = str(date)
+        return len(date) == 6 and date.isascii() and date.isdecimal() and 1 <= int(date[0:2]) <= 31 and 1 <= int(date[2:4]) <= 12
+
+    def _validate_time(self, time_str):
+        """Check that a time is empty or in the HHMM format expected by the API."""
+        if not time_str:
+            return True
+        time_str = str(time_str)
+        return len(time_str) == 4 and time_str.isascii() and time_str.isdecimal() and int(time_str[0:2]) < 24 and int(time_str[2:4]) < 60
+
+    def validate_params(self, method, params=None):
+        """Check that the endpoint exists and only receives parameters it supports.
+
+        Args:
+            method (str): The API endpoint to call.
+            params (dict): The extra query parameters for the request.
+
+        Raises:
+            IRailValidationError: If the endpoint or one of its parameters is invalid.
+
+        """
+        allowed = allowed_params.get(method)
+        if allowed is None:
+            raise IRailValidationError(f"Unknown endpoint: {method}")
+        xor = xor_params.get(method)
+        if xor:
+            present = [param for param in (params or {}).keys() & xor if params[param]]
+            if len(present) != 1:
+                raise IRailValidationError(f"Endpoint {method} requires exactly one of: {', '.join(sorted(xor))}")
+        if params:
+            unexpected = params.keys() - allowed
+            if unexpected:
+                raise IRailValidationError(f"Unexpected parameter(s) for endpoint {method}: {', '.join(sorted(unexpected))}")
+            if not self._validate_date(params.get('date')):
+                raise IRailValidationError(f"Invalid date format. Expected ddmmyy, got: {params['date']}")
+            if not self._validate_time(params.get('time')):
+                raise IRailValidationError(f"Invalid time format. Expected HHMM, got: {params['time']}")
+
     async def do_request(self, method, args=None):
         logger.info("Starting request to endpoint: %s", method)
-        async with self.lock:
-            self._refill_tokens()
+        try:
+            self.validate_params(method, args)
+        except IRailValidationError as e:
+            logger.error("Validation failed: %s", e)
+            return None
+        if self.session is None:
+            logger.error("No active session, use iRail as an async context manager")
+            return None
 
-            if self.tokens < 1:
-                if self.burst_tokens >= 1:
-                    self.burst_tokens -= 1
-                else:
-                    logger.warning("Rate limiting, waiting for tokens")
-                    await asyncio.sleep(1 - (time.time() - self.last_request_time))
-                    self._refill_tokens()
-                    self.tokens -= 1
-            else:
-                self.tokens -= 1
+        params = self._base_params.copy()
+        if args:
+            params.extend((key, value) for key, value in args.items() if value is not None)
+        # List values become repeated query parameters; tuples keep the key hashable
+        cache_key = (method, frozenset((key, tuple(value) if isinstance(value, list) else value) for key, value in params.items()))
+
+        task = self._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(method, params, cache_key))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+        # Concurrent identical requests share one task; cancelling a caller mustn't cancel it
+        result = await asyncio.shield(task)
+        if not isinstance(result, bytes):
+            return result
+        try:
+            return json_loads(result)
+        except ValueError:
+            return -1
 
-        if method in methods:
-            url = base_url.format(method)
-            params = {'format': self.format, 'lang': self.lang}
-            if args:
-                params.update(args)
-            headers = {}
+    async def _fetch(self, method, params, cache_key):
+        """Perform the HTTP request for do_request, honouring the rate limit and ETag cache.
+
+        Returns the raw response body on success, for do_request to parse.
+        """
+        await self._handle_rate_limit()
 
-            # Add If-None-Match header if we have a cached ETag
-            if method in self.etag_cache:
-                logger.debug("Adding If-None-Match header with value: %s", self.etag_cache[method])
-                headers['If-None-Match'] = self.etag_cache[method]
+        url = urls[method]
+        request_headers = None
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            self.response_cache.move_to_end(cache_key)
+            etag = cached[0]
+            logger.debug("Adding If-None-Match header with value: %s", etag)
+            request_headers = {'If-None-Match': etag}
 
+        for attempt in range(MAX_RETRIES):
             try:
-                async with self.session.get(url, params=params, headers=headers) as response:
+                async with self.session.get(url, params=params, headers=request_headers) as response:
                     if response.status == 429:
-                        logger.warning("Rate limited, waiting for retry-after header")
-                        retry_after = int(response.headers.get("Retry-After", 1))
-                        await asyncio.sleep(retry_after)
-                        return await self.do_request(method, args)
-                    if response.status == 200:
-                        # Cache the ETag from the response
-                        if 'Etag' in response.headers:
-                            self.etag_cache[method] = response.headers['Etag']
-                        try:
-                            json_data = await response.json()
-                            return json_data
-                        except ValueError:
-                            return -1
+                        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                        if retry_after is None:
+                            retry_after = random.uniform(0.5, 1) * 2 ** attempt
+                        retry_after = min(retry_after, MAX_RETRY_DELAY)
+                    elif response.status == 200:
+                        body = await response.read()
+                        etag = response.headers.get('ETag')
+                        if etag:
+                            self.response_cache[cache_key] = (etag, body)
+                            self.response_cache.move_to_end(cache_key)
+                            if len(self.response_cache) > RESPONSE_CACHE_SIZE:
+                                self.response_cache.popitem(last=False)
+                        return body
                     elif response.status == 304:
                         logger.info("Data not modified, using cached data")
-                        return None
+                        return cached[1] if cached is not None else None
                     else:
                         logger.error("Request failed with status code: %s", response.status)
                         return None
             except ClientError as e:
-                logger.error("Request failed: %s", e)
-                try:
-                    await self.session.get('https://1.1.1.1/', timeout=1)
-                except ClientError:
-                    logger.error("Internet connection failed")
-                    return -1
-                else:
-                    logger.error("iRail API failed")
-                    return -1
+                logger.error("iRail API request failed: %s", e)
+                return -1
+
+            if attempt == MAX_RETRIES - 1:
+                break
+            logger.warning("Rate limited, retrying in %.1f seconds", retry_after)
+            await asyncio.sleep(retry_after)
+
+        logger.error("Giving up on endpoint %s after %d rate-limited attempts", method, MAX_RETRIES)
+        return None
 
     async def get_stations(self):
         """Retrieve a list of all stations."""
-        json_data = await self.do_request('stations')
-        return json_data
+        return await self.do_request('stations')
 
     async def get_liveboard(self, station=None, id=None):
-        if bool(station) ^ bool(id):
-            extra_params = {'station': station, 'id': id}
-            json_data = await self.do_request('liveboard', extra_params)
-            return json_data
+        return await self.do_request('liveboard', {'station': station, 'id': id})
 
     async def get_connections(self, from_station=None, to_station=None):
         if from_station and to_station:
-            extra_params = {'from': from_station, 'to': to_station}
-            json_data = await self.do_request('connections', extra_params)
-            return json_data
+            return await self.do_request('connections', {'from': from_station, 'to': to_station})
 
     async def get_vehicle(self, id=None):
         if id:
-            extra_params = {'id': id}
-            json_data = await self.do_request('vehicle', extra_params)
-            return json_data
+            return await self.do_request('vehicle', {'id': id})
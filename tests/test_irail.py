@@ -1,8 +1,10 @@
+import asyncio
+
 import pytest
 from unittest.mock import AsyncMock, patch
-from aiohttp import ClientSession
+from aiohttp import ClientConnectionError, ClientSession
 
-from pyrail.irail import iRail
+from pyrail.irail import MAX_RETRIES, MAX_RETRY_DELAY, IRailValidationError, _parse_retry_after, iRail
 
 """
 Unit tests for the iRail API wrapper.
@@ -14,12 +16,13 @@ async def test_successful_request(mock_get):
     """Test a successful API request by mocking the iRail response."""
     mock_response = AsyncMock()
     mock_response.status = 200
-    mock_response.json = AsyncMock(return_value={'data': 'some_data'})
+    mock_response.headers = {}
+    mock_response.read = AsyncMock(return_value=b'{"data": "some_data"}')
     mock_get.return_value.__aenter__.return_value = mock_response
 
     async with iRail() as api:
         response = await api.do_request('stations')
-        mock_get.assert_called_once_with('https://api.irail.be/stations/', params={'format': 'json', 'lang': 'en'}, headers={})
+        mock_get.assert_called_once_with('https://api.irail.be/stations/', params={'format': 'json', 'lang': 'en'}, headers=None)
         assert response == {'data': 'some_data'}
 
 @pytest.mark.asyncio
@@ -65,3 +68,230 @@ async def test_get_connections():
         connection_list = connections.get('connection', [])
         assert isinstance(connection_list, list), "Expected 'connection' to be a list"
         assert len(connection_list) > 0, "Expected at least one connection in the response"
+
+def test_validate_params():
+    """Test that unknown endpoints and unsupported parameters are rejected."""
+    api = iRail()
+    api.validate_params('stations')
+    api.validate_params('vehicle', {'id': 'BE.NMBS.IC1832'})
+    with pytest.raises(IRailValidationError):
+        api.validate_params('unknown')
+    with pytest.raises(IRailValidationError):
+        api.validate_params('vehicle', {'foo': 'bar'})
+    api.validate_params('liveboard', {'station': 'Brussel-Centraal', 'id': None})
+    with pytest.raises(IRailValidationError):
+        api.validate_params('liveboard', {'station': 'Brussel-Centraal', 'id': 'BE.NMBS.008813003'})
+    with pytest.raises(IRailValidationError):
+        api.validate_params('liveboard')
+    with pytest.raises(IRailValidationError):
+        api.validate_params('liveboard', {'station': '', 'id': None})
+
+def test_validate_date_and_time():
+    """Test the fixed-width date and time checks."""
+    api = iRail()
+    assert api._validate_date('311224')
+    assert api._validate_date(None)
+    assert not api._validate_date('321224')
+    assert not api._validate_date('2024-12-31')
+    assert api._validate_time('2359')
+    assert not api._validate_time('2400')
+    assert not api._validate_time('12:30')
+    assert api._validate_time(1230)
+    assert api._validate_date(311224)
+    assert not api._validate_time('²²²²')
+    assert not api._validate_date('３１１２２４')
+    api.validate_params('liveboard', {'station': 'Gent-Sint-Pieters', 'time': 1230})
+    with pytest.raises(IRailValidationError):
+        api.validate_params('liveboard', {'station': 'Gent-Sint-Pieters', 'date': '010124', 'time': '9999'})
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_unset_params_are_dropped(mock_get):
+    """Test that parameters left at None are not sent to the API."""
+    mock_response = AsyncMock()
+    mock_response.status = 200
+    mock_response.headers = {}
+    mock_response.read = AsyncMock(return_value=b'{"data": "some_data"}')
+    mock_get.return_value.__aenter__.return_value = mock_response
+
+    async with iRail() as api:
+        await api.get_liveboard(station='Brussel-Centraal')
+        assert mock_get.call_args.kwargs['params'] == {'format': 'json', 'lang': 'en', 'station': 'Brussel-Centraal'}
+
+@pytest.mark.asyncio
+async def test_rate_limit_waits_for_missing_token_only():
+    """Test that an empty bucket sleeps only until the next token is available."""
+    api = iRail()
+    api.tokens = 0.5
+    api.burst_tokens = 0
+    loop = asyncio.get_running_loop()
+    api.last_request_time = start = loop.time()
+    await api._handle_rate_limit()
+    # Half a token is missing at 3 tokens per second
+    assert 0.5 / 3 - 0.05 <= loop.time() - start < 1
+    assert api.tokens >= 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_waiter_uses_refilled_burst_tokens():
+    """Test that a queued caller takes a burst token as soon as one is available."""
+    api = iRail()
+    api.tokens = 0
+    api.burst_tokens = 0.5
+    loop = asyncio.get_running_loop()
+    api.last_request_time = start = loop.time()
+    await api._handle_rate_limit()
+    assert loop.time() - start < 0.5 / 3 + 0.1
+    assert api.burst_tokens < 1
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_not_modified_returns_cached_data(mock_get):
+    """Test that a 304 response returns the body cached with the matching ETag."""
+    mock_response = AsyncMock()
+    mock_response.status = 200
+    mock_response.headers = {'ETag': '"abc"'}
+    mock_response.read = AsyncMock(return_value=b'{"data": "some_data"}')
+    mock_get.return_value.__aenter__.return_value = mock_response
+
+    async with iRail() as api:
+        first = await api.do_request('stations')
+        assert first == {'data': 'some_data'}
+        # Mutating a returned result must not leak into later cache hits
+        first['data'] = 'changed'
+
+        mock_response.status = 304
+        mock_response.read = AsyncMock(side_effect=ValueError)
+        assert await api.do_request('stations') == {'data': 'some_data'}
+        assert mock_get.call_args.kwargs['headers'] == {'If-None-Match': '"abc"'}
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_rate_limited_request_is_retried(mock_get):
+    """Test that a 429 response is retried after the Retry-After delay."""
+    rate_limited = AsyncMock()
+    rate_limited.status = 429
+    rate_limited.headers = {'Retry-After': '2'}
+    ok = AsyncMock()
+    ok.status = 200
+    ok.headers = {}
+    ok.read = AsyncMock(return_value=b'{"data": "some_data"}')
+    mock_get.return_value.__aenter__.side_effect = [rate_limited, ok]
+
+    async with iRail() as api:
+        with patch('pyrail.irail.asyncio.sleep', new_callable=AsyncMock) as mock_sleep:
+            response = await api.do_request('stations')
+        mock_sleep.assert_awaited_once_with(2)
+        assert mock_get.call_count == 2
+        assert response == {'data': 'some_data'}
+
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_rate_limited_request_gives_up_with_capped_delay(mock_get):
+    """Test that huge Retry-After values are capped and the last attempt doesn't sleep."""
+    rate_limited = AsyncMock()
+    rate_limited.status = 429
+    rate_limited.headers = {'Retry-After': '86400'}
+    mock_get.return_value.__aenter__.return_value = rate_limited
+
+    async with iRail() as api:
+        with patch('pyrail.irail.asyncio.sleep', new_callable=AsyncMock) as mock_sleep:
+            response = await api.do_request('stations')
+        assert response is None
+        assert mock_get.call_count == MAX_RETRIES
+        assert mock_sleep.await_count == MAX_RETRIES - 1
+        assert all(call.args[0] == MAX_RETRY_DELAY for call in mock_sleep.await_args_list)
+
+
+def test_parse_retry_after():
+    """Test parsing Retry-After in both delta-seconds and HTTP-date form."""
+    assert _parse_retry_after('3') == 3
+    assert _parse_retry_after(None) is None
+    assert _parse_retry_after('soon') is None
+    assert _parse_retry_after('²') is None
+    assert _parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_concurrent_identical_requests_are_coalesced(mock_get):
+    """Test that concurrent identical requests share a single HTTP call."""
+    mock_response = AsyncMock()
+    mock_response.status = 200
+    mock_response.headers = {}
+    mock_response.read = AsyncMock(return_value=b'{"data": "some_data"}')
+    mock_get.return_value.__aenter__.return_value = mock_response
+
+    async with iRail() as api:
+        responses = await asyncio.gather(api.get_stations(), api.get_stations())
+        assert responses == [{'data': 'some_data'}, {'data': 'some_data'}]
+        assert responses[0] is not responses[1]
+        mock_get.assert_called_once()
+        assert not api._inflight
+
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.RESPONSE_CACHE_SIZE', 2)
+@patch('pyrail.irail.ClientSession.get')
+async def test_response_cache_evicts_least_recently_used(mock_get):
+    """Test that the response cache stays bounded by evicting the oldest entry."""
+    mock_response = AsyncMock()
+    mock_response.status = 200
+    mock_response.headers = {'ETag': '"abc"'}
+    mock_response.read = AsyncMock(return_value=b'{"data": "some_data"}')
+    mock_get.return_value.__aenter__.return_value = mock_response
+
+    async with iRail() as api:
+        for time in ('1000', '1001', '1002'):
+            await api.do_request('liveboard', {'station': 'Brussel-Centraal', 'time': time})
+        assert len(api.response_cache) == 2
+        assert all(('time', '1000') not in params for _, params in api.response_cache)
+
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_list_params_are_sent(mock_get):
+    """Test that list values, sent as repeated query parameters, don't break request keying."""
+    mock_response = AsyncMock()
+    mock_response.status = 200
+    mock_response.headers = {}
+    mock_response.read = AsyncMock(return_value=b'{"data": "some_data"}')
+    mock_get.return_value.__aenter__.return_value = mock_response
+
+    async with iRail() as api:
+        response = await api.do_request('connections', {'from': 'A', 'to': 'B', 'typeOfTransport': ['train', 'bus']})
+        assert response == {'data': 'some_data'}
+        assert mock_get.call_args.kwargs['params'].getall('typeOfTransport') == [['train', 'bus']]
+
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_orphaned_request_is_cancelled_on_exit(mock_get):
+    """Test that a shared request whose callers were all cancelled is stopped on exit."""
+    async def hang(*args, **kwargs):
+        await asyncio.Event().wait()
+
+    mock_get.return_value.__aenter__.side_effect = hang
+
+    async with iRail() as api:
+        caller = asyncio.ensure_future(api.get_stations())
+        await asyncio.sleep(0.01)
+        task = next(iter(api._inflight.values()))
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        assert not task.done()
+
+    assert task.cancelled()
+    assert not api._inflight
+
+
+@pytest.mark.asyncio
+@patch('pyrail.irail.ClientSession.get')
+async def test_connection_error_makes_no_further_requests(mock_get):
+    """Test that a connection failure returns -1 without probing the network again."""
+    mock_get.return_value.__aenter__.side_effect = ClientConnectionError('connection refused')
+
+    async with iRail() as api:
+        assert await api.do_request('stations') == -1
+        mock_get.assert_called_once()